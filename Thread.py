@@ -1,9 +1,32 @@
+import os
 from pathlib import Path
+from collections import defaultdict, namedtuple
 import re
 from util.enums import ModSince, OnMatch, get_mod_enum, get_on_match_enum
+from util.ratelimit import RateLimiter
 import json
-from requests import get
-from time import time, sleep
+from email.utils import formatdate
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from time import time
+from shutil import copyfileobj
+from functools import cache, cached_property
+
+
+_URL_RE = re.compile(r'boards\.4chan(?:nel)?\.org/([^/]+)/thread/(\d+)')
+
+# Where a post's file is saved to, and its name on the image CDN
+FileJob = namedtuple('FileJob', 'path file')
+
+
+@cache
+def _ensure_dir(path):
+    # Created on first write rather than at startup, and only stat'ed once
+    path.mkdir(parents=True, exist_ok=True)
+    return path
 
 
 class Thread:
@@ -13,13 +36,17 @@ class Thread:
         self._id = post_id
         self._cached_file = Thread.cache_path / \
             f'{self._board}:{self._id}.json'
+        self._meta_file = Thread.cache_path / \
+            f'{self._board}:{self._id}.meta'
+        self._dead_file = Thread.cache_path / \
+            f'{self._board}:{self._id}.404'
         self._structure_info = {'board': self._board, 'thread': self._id}
 
     def _gen_path(self):
         op = self._data['posts'][0]
-        if 'sub' in op.keys():
+        if 'sub' in op:
             self._structure_info['title'] = op['sub']
-        elif 'com' in op.keys():
+        elif 'com' in op:
             end = len(op['com']) - 1
             if end > 15:
                 end = 15
@@ -29,8 +56,8 @@ class Thread:
 
         template = Thread.structure.lower()
         for t in ['board', 'thread', 'title']:
-            (template, _) = re.subn(r'\%\(' + t + r'\)',
-                                    self._structure_info[t], template)
+            template = template.replace(f'%({t})',
+                                        str(self._structure_info[t]))
         self._path = template
 
     def download(self):
@@ -51,104 +78,226 @@ class Thread:
             try:
                 if self._data['posts'][0]['closed'] == 1:
                     self._cached_file.unlink()
+                    self._meta_file.unlink(missing_ok=True)
             except KeyError:
                 pass
 
     def _download_files(self):
-        container = Path(self._files[0]['path'].parent)
+        container = Path(self._files[0].path.parent)
         container.mkdir(parents=True, exist_ok=True)
-        succ = 0
-        errs = 0
         count = len(self._files)
 
-        for index, f in enumerate(self._files):
-            api_url = f'https://i.4cdn.org/{self._board}/{f["file"]}'
-            print(f'[{index + 1}/{count}] Fetching: {api_url}')
-            start_time = time()
-            resp = get(api_url, stream=True)
-            if resp.status_code == 200:
-                print(f'Saving to {str(f["path"])}')
-                with f['path'].open(mode='wb') as outfile:
-                    for chunk in resp.iter_content(4096):
-                        outfile.write(chunk)
-                succ += 1
-            else:
-                errs += 1
-            end_time = time()
-            elapsed = end_time - start_time
-            if elapsed < 1:
-                sleep(1 - elapsed)
-        return (succ, errs)
+        with ThreadPoolExecutor(max_workers=Thread.workers) as pool:
+            results = pool.map(self._download_file, self._files,
+                               range(1, count + 1), repeat(count))
+            succ = sum(results)
+        return (succ, count - succ)
+
+    def _download_file(self, f, index, count):
+        api_url = f'https://i.4cdn.org/{self._board}/{f.file}'
+        # Bodies are written to a .part file and renamed when complete, so an
+        # interrupted download is resumed instead of passing for a finished file.
+        # The partial is named after the CDN file, not the local name, since a
+        # local name can map to a different post on the next run
+        part = f.path.with_name(f'{f.file}.part')
+        part_meta = f.path.with_name(f'{f.file}.part.meta')
+        try:
+            offset = part.stat().st_size
+            validators = json.loads(part_meta.read_bytes())
+        except (FileNotFoundError, ValueError):
+            # A missing or unreadable sidecar means starting over; the 200
+            # below writes a fresh one
+            offset = 0
+            validators = dict()
+        # Only resume when the server can confirm the bytes we hold are from
+        # the same version of the file
+        validator = validators.get('ETag') or validators.get('LastModified')
+        if offset and validator:
+            headers = {'Range': f'bytes={offset}-', 'If-Range': validator}
+        else:
+            offset = 0
+            headers = None
+        print(f'[{index}/{count}] Fetching: {api_url}')
+        resp = Thread.session.get(api_url, headers=headers, stream=True)
+        match resp.status_code:
+            case 200:
+                mode = 'wb'
+                part_meta.write_text(json.dumps({
+                    'ETag': resp.headers.get('ETag'),
+                    'LastModified': resp.headers.get('Last-Modified')}))
+            case 206:
+                mode = 'ab'
+            case 416 if resp.headers.get('Content-Range') == f'bytes */{offset}':
+                # The previous run got the whole body but never renamed it
+                part.replace(f.path)
+                part_meta.unlink(missing_ok=True)
+                return True
+            case 416:
+                # The partial doesn't fit the file on the server, start over
+                part.unlink(missing_ok=True)
+                part_meta.unlink(missing_ok=True)
+                return self._download_file(f, index, count)
+            case _:
+                return False
+        print(f'Saving to {str(f.path)}')
+        # Large files (mostly webms) get bigger chunks and fewer write calls
+        size = int(resp.headers.get('Content-Length', 0))
+        length = 1 << 20 if size > 1 << 20 else 1 << 16
+        resp.raw.decode_content = True
+        with part.open(mode=mode) as outfile:
+            copyfileobj(resp.raw, outfile, length)
+        part.replace(f.path)
+        part_meta.unlink(missing_ok=True)
+        return True
 
     def _get_files(self):
         posts = self._data['posts']
 
         self._files = []
+        self._existing = dict()
+        self._queued = set()
+        # Next counter to try for each colliding path, so repeated
+        # collisions don't rescan from (1)
+        self._append_counters = defaultdict(lambda: 1)
 
-        if Thread.reverse:
-            i = len(posts) - 1
-            length = -1
-            inc = -1
-        else:
-            length = len(posts)
-            i = 0
-            inc = 1
-
-        while i != length:
-            if 'filename' in posts[i].keys():
-
-                fpath = Path(Thread.path) / self._gen_full_path(posts[i])
-                if fpath.exists():
-                    match Thread.on_match:
-                        case OnMatch.APPEND:
-                            counter = 1
-                            while fpath.exists():
-                                fpath = Path(
-                                    fpath.parents[0] / f'{fpath.stem}({counter}){fpath.suffixes}')
-                            self._files.append({
-                                'path': fpath, 'file': f'{posts[i]["tim"]}{posts[i]["ext"]}'})
-                        case OnMatch.REPLACE:
-                            self._files.append(
-                                {'path': fpath, 'file': f'{posts[i]["tim"]}{posts[i]["ext"]}'})
-                        case OnMatch.SKIP:
-                            pass
-                        case OnMatch.STOP:
-                            return
-                else:
-                    self._files.append(
-                        {'path': fpath, 'file': f'{posts[i]["tim"]}{posts[i]["ext"]}'})
-            i = i + inc
+        # Read the settings once rather than on every post
+        handler = Thread._match_handlers.get(Thread.on_match)
+        base = str(Thread.path)
+
+        for post in reversed(posts) if Thread.reverse else posts:
+            if 'filename' in post:
+
+                # Plain strings until the path is queued; building a Path per
+                # post is noticeably slower on large threads
+                container, name = os.path.split(
+                    os.path.join(base, self._gen_full_path(post)))
+                existing = self._existing_names(container)
+                if name in existing:
+                    # OnMatch.STOP has no handler
+                    if handler is None:
+                        return
+                    name = handler(self, container, name, existing)
+                    if name is None:
+                        continue
+                existing.add(name)
+                self._queued.add((container, name))
+                self._files.append(
+                    FileJob(Path(container, name), f'{post["tim"]}{post["ext"]}'))
+
+    def _append_name(self, container, name, existing):
+        key = (container, name)
+        stem, suffix = os.path.splitext(name)
+        counter = self._append_counters[key]
+        while name in existing:
+            name = f'{stem}({counter}){suffix}'
+            counter += 1
+        self._append_counters[key] = counter
+        return name
+
+    def _replace_name(self, container, name, existing):
+        # Overwrite what's on disk, but never queue two downloads to one path
+        if (container, name) in self._queued:
+            return None
+        return name
+
+    def _skip_name(self, container, name, existing):
+        return None
+
+    _match_handlers = {
+        OnMatch.APPEND: _append_name,
+        OnMatch.REPLACE: _replace_name,
+        OnMatch.SKIP: _skip_name,
+    }
+
+    def _existing_names(self, container):
+        # One directory listing per container instead of a stat per file
+        if container not in self._existing:
+            try:
+                with os.scandir(container) as entries:
+                    self._existing[container] = {e.name for e in entries}
+            except FileNotFoundError:
+                self._existing[container] = set()
+        return self._existing[container]
 
     def _gen_full_path(self, post):
-        temp = self._path
-        for t in [('id', 'tim'), ('post', 'no'), ('file', 'filename'), ('ext', 'ext')]:
-            (temp, _) = re.subn(
-                r'\%\(' + t[0] + r'\)', str(post[t[1]]), temp)
+        temp = self._path \
+            .replace('%(id)', str(post['tim'])) \
+            .replace('%(post)', str(post['no'])) \
+            .replace('%(file)', post['filename']) \
+            .replace('%(ext)', post['ext'])
         return ''.join([temp, post['ext']])
 
     def _get_json_data(self):
         api_url = f'https://a.4cdn.org/{self._board}/thread/{self._id}.json'
+        try:
+            if time() - self._dead_file.stat().st_mtime < Thread.dead_ttl:
+                self._body = None
+                return
+        except FileNotFoundError:
+            pass
         header_dict = dict()
-        cached_data = None
+        validators = None
         if self._cached_file.exists() and Thread.modified_since != ModSince.IGNORE:
-            cached_data = json.loads(self._cached_file.read_bytes())
-            header_dict['If-Modified-Since'] = cached_data['LastModified']
-        resp = get(api_url, headers=header_dict)
-        if resp.status_code == 200 and resp.headers['content-type'] == 'application/json':
-            new_cache = {
-                'LastModified': resp.headers['Last-Modified'],
-                'json': resp.json()
-            }
-            self._cached_file.write_text(json.dumps(new_cache))
-            self._data = new_cache['json']
-        elif resp.status_code == 304 and Thread.modified_since == ModSince.REUSE and cached_data is not None:
-            self._data = cached_data['json']
+            # Only the small sidecar is read up front; the thread JSON itself
+            # is parsed once the server says it is still current
+            try:
+                validators = json.loads(self._meta_file.read_bytes())
+            except (FileNotFoundError, ValueError):
+                # Falls back to the cache file's mtime below
+                validators = dict()
+            if validators.get('LastModified'):
+                header_dict['If-Modified-Since'] = validators['LastModified']
+            else:
+                header_dict['If-Modified-Since'] = formatdate(
+                    self._cached_file.stat().st_mtime, usegmt=True)
+            if validators.get('ETag'):
+                header_dict['If-None-Match'] = validators['ETag']
+        # Only the JSON API asks for one request per second; the image CDN
+        # is limited by the worker count alone
+        Thread.api_limiter.wait()
+        resp = Thread.session.get(api_url, headers=header_dict)
+        last_modified = resp.headers.get('Last-Modified')
+        etag = resp.headers.get('ETag')
+        # A 200 carrying the Last-Modified we already have is as good as a 304,
+        # unless both sides have an ETag and they disagree
+        unchanged = resp.status_code == 304 or (
+            resp.status_code == 200 and validators is not None
+            and last_modified is not None
+            and last_modified == validators.get('LastModified')
+            and (etag is None or validators.get('ETag') is None
+                 or etag == validators['ETag']))
+        if resp.status_code == 200 and not unchanged and resp.headers['content-type'] == 'application/json':
+            # The body is cached verbatim and only parsed when _data is used
+            _ensure_dir(Thread.cache_path)
+            self._cached_file.write_bytes(resp.content)
+            self._meta_file.write_text(json.dumps(
+                {'LastModified': last_modified, 'ETag': etag}))
+            self._body = resp.content
+        elif unchanged and Thread.modified_since == ModSince.REUSE and validators is not None:
+            if resp.status_code == 200:
+                self._body = resp.content
+            else:
+                self._body = self._cached_file.read_bytes()
         else:
-            self._data = None
+            if resp.status_code == 404:
+                _ensure_dir(Thread.cache_path)
+                self._dead_file.touch()
+            self._body = None
+
+    @cached_property
+    def _data(self):
+        if self._body is None:
+            return None
+        data = json.loads(self._body)
+        # Caches written before bodies were stored verbatim wrap the thread
+        return data.get('json', data)
+
+    def forget_dead(self):
+        self._dead_file.unlink(missing_ok=True)
 
     @staticmethod
     def from_url(url):
-        match = re.search(r'boards\.4chan(?:nel)?\.org/(.+)/thread/(\d+)', url)
+        match = _URL_RE.search(url)
         if match is not None:
             return Thread(match.group(1), match.group(2))
         else:
@@ -163,3 +312,11 @@ class Thread:
         Thread.cache_path = Path(cache_path).expanduser()
         Thread.modified_since = get_mod_enum(modified_since)
         Thread.on_match = get_on_match_enum(on_match)
+        Thread.workers = 4
+        Thread.dead_ttl = 24 * 60 * 60
+        Thread.api_limiter = RateLimiter(1)
+        Thread.session = Session()
+        Thread.session.headers['User-Agent'] = 'sukureipu'
+        Thread.session.mount('https://', HTTPAdapter(
+            pool_connections=2, pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3)))
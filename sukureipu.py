@@ -87,22 +87,15 @@ def main():
 
     # board name, thread number
     threads = []
-    if args['refresh']:
-        if args['<BOARD>']:
-            if args['<THREAD>']:
-                threads.append(Thread(args['<BOARD>'], args['<THREAD>']))
-            else:
-                # Get all cached files that match board
-                # Generate structure_info for all of them
-                thread_params = [f.stem.split(':') for f in Thread.cache_path.iterdir(
-                ) if f.stem.startswith(args['<BOARD>'])]
-                for param in thread_params:
-                    threads.append(Thread(param[0], param[1]))
-        else:
-            thread_params = [f.stem.split(':') for f in Thread.cache_path.iterdir(
-            )]
-            for param in thread_params:
-                threads.append(Thread(param[0], param[1]))
+    if args['refresh'] and args['<THREAD>']:
+        thread = Thread(args['<BOARD>'], args['<THREAD>'])
+        thread.forget_dead()
+        threads.append(thread)
+    elif args['refresh']:
+        # Get all cached files, optionally only those from one board
+        board = args['<BOARD>'] or '*'
+        for f in Thread.cache_path.glob(f'{board}:*.json'):
+            threads.append(Thread(*f.stem.split(':')))
     else:
         for url in args['<URL>']:
             if (t := Thread.from_url(url)) is not None:
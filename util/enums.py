@@ -14,23 +14,23 @@ class OnMatch(Enum):
     STOP = 4
 
 
+_MOD_SINCE = {
+    'reuse': ModSince.REUSE,
+    'stop': ModSince.STOP,
+    'ignore': ModSince.IGNORE,
+}
+
+_ON_MATCH = {
+    'append': OnMatch.APPEND,
+    'replace': OnMatch.REPLACE,
+    'skip': OnMatch.SKIP,
+    'stop': OnMatch.STOP,
+}
+
+
 def get_mod_enum(mod_since):
-    match mod_since:
-        case 'reuse':
-            return ModSince.REUSE
-        case 'stop':
-            return ModSince.STOP
-        case 'ignore':
-            return ModSince.IGNORE
+    return _MOD_SINCE.get(mod_since)
 
 
 def get_on_match_enum(on_match):
-    match on_match:
-        case 'append':
-            return OnMatch.APPEND
-        case 'replace':
-            return OnMatch.REPLACE
-        case 'skip':
-            return OnMatch.SKIP
-        case 'STOP':
-            return OnMatch.STOP
+    return _ON_MATCH.get(on_match)
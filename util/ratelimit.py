@@ -0,0 +1,20 @@
+from threading import Lock
+from time import monotonic, sleep
+
+
+class RateLimiter:
+
+    def __init__(self, interval):
+        self._interval = interval
+        self._lock = Lock()
+        self._next = 0.0
+
+    def wait(self):
+        # Reserve the next free slot under the lock, then sleep outside of it
+        # so other workers can queue up behind us
+        with self._lock:
+            now = monotonic()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            sleep(start - now)